@@ -118,6 +118,8 @@ def zoom_video_composer_gradio(
         resampling=resampling,
         margin=margin,
         output=output,
+        # Worker processes would import this module again, threads don't
+        executor="thread",
     )
 
 
@@ -133,4 +135,5 @@ iface = gr.Interface(
     allow_download=True,
 )
 
-iface.queue(concurrency_count=1).launch()
+if __name__ == "__main__":
+    iface.queue(concurrency_count=1).launch()
@@ -22,19 +22,54 @@
 # SOFTWARE.
 
 import os
-from math import cos, pi, sin, pow, ceil
+import queue
+import subprocess
+import threading
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import lru_cache
+from math import pi
+from multiprocessing import shared_memory
 
 import cv2
 import gradio as gr
-from PIL import Image
-from moviepy.audio.io.AudioFileClip import AudioFileClip
-from moviepy.video.io.ImageSequenceClip import ImageSequenceClip
-from proglog import TqdmProgressBarLogger
-from tqdm import trange
+import numpy as np
+from PIL import Image, __version__ as PIL_VERSION
+from moviepy.config import get_setting
+from tqdm import tqdm
+
+# Make sure the SIMD optimized code paths of OpenCV are enabled
+cv2.setUseOptimized(True)
+
+# pyvips is optional, it is used to speed up downscaling of large images if available
+try:
+    import pyvips
+
+    pyvips.cache_set_max(0)
+except (ImportError, OSError):
+    pyvips = None
+
+
+# Saved images are only intermediate files, so fast compression is preferred over the file size
+CV2_SAVE_PARAMS = {
+    ".png": [cv2.IMWRITE_PNG_COMPRESSION, 1],
+    ".jpg": [cv2.IMWRITE_JPEG_QUALITY, 95],
+}
+PIL_SAVE_PARAMS = {
+    ".png": {"compress_level": 1},
+    ".jpg": {"quality": 95},
+}
+FRAME_FORMATS = ["png", "jpg", "bmp"]
+DEFAULT_FRAME_FORMAT = "png"
 
 
 # Image classes - PIL and CV2
 class ImageWrapper(object):
+    # Pixel format of the raw bytes returned by tobytes, as understood by ffmpeg
+    pix_fmt = None
+    # If True, zoom_crop_resize gives the same result for all zooms with the same rounded size of the zoomed image
+    rounds_zoom_size = True
+
     def __init__(self):
         self.width = 0
         self.height = 0
@@ -43,10 +78,31 @@ class ImageWrapper(object):
     def load(image_path):
         raise NotImplementedError
 
+    @staticmethod
+    def frombytes(data, width, height):
+        raise NotImplementedError
+
     def save(self, image_path):
         raise NotImplementedError
 
-    def resize(self, size, resampling_func):
+    def tobytes(self):
+        raise NotImplementedError
+
+    # Raw bytes in the yuv420p format used by the encoder, so ffmpeg doesn't need to convert the frames
+    def toyuv420bytes(self):
+        image = np.frombuffer(self.tobytes(), dtype=np.uint8)
+        return rgb_to_yuv420(image.reshape(self.height, self.width, 3), self.pix_fmt)
+
+    # Pixels as a numpy array and back, used to share the images with the worker processes
+    def asarray(self):
+        raise NotImplementedError
+
+    @staticmethod
+    def fromarray(array):
+        raise NotImplementedError
+
+    # If dst is given, the engine may write the resized image into this buffer instead of allocating a new one
+    def resize(self, size, resampling_func, dst=None):
         raise NotImplementedError
 
     def crop(self, crop_box):
@@ -55,15 +111,40 @@ class ImageWrapper(object):
     def paste(self, image, x, y):
         raise NotImplementedError
 
+    def pyr_down(self):
+        raise NotImplementedError
+
     def zoom_crop(self, zoom, resampling_func):
-        zoom_size = (int(self.width * zoom), int(self.height * zoom))
+        width, height = self.width, self.height
+        zoom_width, zoom_height = int(width * zoom), int(height * zoom)
+        return self.resize((zoom_width, zoom_height), resampling_func).crop_center(
+            width, height
+        )
+
+    def crop_center(self, width, height):
         crop_box = (
-            int((zoom_size[0] - self.width) / 2),
-            int((zoom_size[1] - self.height) / 2),
-            int((zoom_size[0] + self.width) / 2),
-            int((zoom_size[1] + self.height) / 2),
+            int((self.width - width) / 2),
+            int((self.height - height) / 2),
+            int((self.width + width) / 2),
+            int((self.height + height) / 2),
         )
-        return self.resize(zoom_size, resampling_func).crop(crop_box)
+        return self.crop(crop_box)
+
+    # Same as zoom_crop followed by resize, engines can override it to do both in one pass.
+    # If downscale_resampling_func is given, it is used for the final resize when it shrinks the image more than 2x
+    def zoom_crop_resize(
+        self, zoom, size, resampling_func, dst=None, downscale_resampling_func=None
+    ):
+        image = self
+        if zoom != 1.0:
+            image = self.zoom_crop(zoom, resampling_func)
+        # Near the ends of the zoom, the crop may already have the size of the frame
+        if (image.width, image.height) == tuple(size):
+            return image
+        final_resampling_func = get_final_resampling_function(
+            self.width, size[0], resampling_func, downscale_resampling_func
+        )
+        return image.resize(size, final_resampling_func, dst=dst)
 
     def resize_scale(self, scale, resampling_func):
         return self.resize(
@@ -72,31 +153,209 @@ class ImageWrapper(object):
 
 
 class ImageCV2(ImageWrapper):
+    pix_fmt = "bgr24"
+
     def __init__(self, image):
         super().__init__()
         self.image = image
         self.height, self.width = self.image.shape[:2]
 
-    @staticmethod
-    def load(image_path):
-        return ImageCV2(cv2.imread(image_path))
+    @classmethod
+    def load(cls, image_path):
+        return cls(cv2.imread(image_path))
 
-    def save(self, image_path):
-        cv2.imwrite(image_path, self.image)
+    @classmethod
+    def frombytes(cls, data, width, height):
+        return cls(np.frombuffer(data, dtype=np.uint8).reshape(height, width, 3))
 
-    def resize(self, size, resampling_func):
-        new_image = cv2.resize(self.image, size, interpolation=resampling_func)
-        return ImageCV2(new_image)
+    def save(self, image_path):
+        ext = os.path.splitext(image_path)[1].lower()
+        cv2.imwrite(image_path, self.image, CV2_SAVE_PARAMS.get(ext, []))
+
+    def tobytes(self):
+        return self.image.tobytes()
+
+    def toyuv420bytes(self):
+        return rgb_to_yuv420(self.image, self.pix_fmt)
+
+    def asarray(self):
+        return self.image
+
+    @classmethod
+    def fromarray(cls, array):
+        return cls(array)
+
+    def resize(self, size, resampling_func, dst=None):
+        if (
+            pyvips is not None
+            and resampling_func in VIPS_KERNELS
+            and self.width * self.height > VIPS_MIN_PIXELS
+            and size[0] <= self.width
+            and size[1] <= self.height
+        ):
+            new_image = resize_vips(self.image, size, VIPS_KERNELS[resampling_func])
+        else:
+            new_image = cv2.resize(
+                self.image, size, dst=dst, interpolation=resampling_func
+            )
+        return self.__class__(new_image)
 
     def crop(self, crop_box):
         new_image = self.image[crop_box[1] : crop_box[3], crop_box[0] : crop_box[2]]
-        return ImageCV2(new_image)
+        return self.__class__(new_image)
+
+    # The zoomed image is resized into the reusable scratch buffer of the worker
+    def zoom_crop_resize(
+        self, zoom, size, resampling_func, dst=None, downscale_resampling_func=None
+    ):
+        image = self
+        zoom_size = (int(self.width * zoom), int(self.height * zoom))
+        final_resampling_func = get_final_resampling_function(
+            self.width, size[0], resampling_func, downscale_resampling_func
+        )
+        if (
+            zoom_size != (self.width, self.height)
+            and final_resampling_func == resampling_func
+            and resampling_func in WARP_INTERPOLATIONS
+        ):
+            new_image = warp_zoom_crop(
+                self.image, zoom_size, size, resampling_func, dst=dst
+            )
+            return self.__class__(new_image)
+        if zoom_size != (self.width, self.height):
+            scratch = get_scratch_buffer(
+                (zoom_size[1], zoom_size[0]) + self.image.shape[2:]
+            )
+            image = self.resize(zoom_size, resampling_func, dst=scratch)
+            image = image.crop_center(self.width, self.height)
+        # Near the ends of the zoom, the crop may already have the size of the frame
+        if (image.width, image.height) == tuple(size):
+            return image
+        return image.resize(size, final_resampling_func, dst=dst)
 
     def paste(self, image, x, y):
         self.image[y : y + image.height, x : x + image.width] = image.image
 
+    def pyr_down(self):
+        # Box filter keeps the level sharper than the Gaussian cv2.pyrDown
+        new_image = cv2.resize(
+            self.image,
+            ((self.width + 1) // 2, (self.height + 1) // 2),
+            interpolation=cv2.INTER_AREA,
+        )
+        return self.__class__(new_image)
+
+
+def rgb_to_yuv420(image, pix_fmt):
+    code = cv2.COLOR_BGR2YUV_I420 if pix_fmt == "bgr24" else cv2.COLOR_RGB2YUV_I420
+    height, width = image.shape[:2]
+    dst = get_yuv420_buffer(width, height)
+    return cv2.cvtColor(image, code, dst=dst).tobytes()
+
+
+# Interpolations supported by cv2.warpAffine, the others (e.g. area) are only supported by cv2.resize
+WARP_INTERPOLATIONS = (
+    cv2.INTER_NEAREST,
+    cv2.INTER_LINEAR,
+    cv2.INTER_CUBIC,
+    cv2.INTER_LANCZOS4,
+)
+
+
+# Samples the frame directly from the image with a single affine warp.
+# The geometry is the same as resizing the image to zoom_size, cropping its center and resizing it to size,
+# so the result depends only on the rounded zoom_size, but the large zoomed image is never created.
+def warp_zoom_crop(image, zoom_size, size, interpolation, dst=None):
+    height, width = image.shape[:2]
+    crop_x, crop_y = int((zoom_size[0] - width) / 2), int((zoom_size[1] - height) / 2)
+    scale_x, scale_y = width / zoom_size[0], height / zoom_size[1]
+    step_x, step_y = width / size[0] * scale_x, height / size[1] * scale_y
+    # Maps the centers of the output pixels to the coordinates in the image
+    matrix = np.array(
+        [
+            [step_x, 0, 0.5 * step_x + crop_x * scale_x - 0.5],
+            [0, step_y, 0.5 * step_y + crop_y * scale_y - 0.5],
+        ]
+    )
+    return cv2.warpAffine(
+        image,
+        matrix,
+        size,
+        dst=dst,
+        flags=interpolation | cv2.WARP_INVERSE_MAP,
+        borderMode=cv2.BORDER_REFLECT_101,
+    )
+
+
+# libvips shrinks large images faster than OpenCV, but it is slower for upscaling
+VIPS_MIN_PIXELS = 2_000_000
+VIPS_KERNELS = {
+    cv2.INTER_NEAREST: "nearest",
+    cv2.INTER_LINEAR: "linear",
+    cv2.INTER_CUBIC: "cubic",
+    cv2.INTER_LANCZOS4: "lanczos3",
+}
+
+
+def resize_vips(image, size, kernel):
+    height, width, bands = image.shape
+    vips_image = pyvips.Image.new_from_memory(
+        np.ascontiguousarray(image).data, width, height, bands, "uchar"
+    )
+    vips_image = vips_image.resize(
+        size[0] / width, vscale=size[1] / height, kernel=kernel
+    )
+    new_image = np.ndarray(
+        buffer=vips_image.write_to_memory(),
+        dtype=np.uint8,
+        shape=(vips_image.height, vips_image.width, vips_image.bands),
+    )
+    # libvips rounds the output size on its own
+    if new_image.shape[:2] != (size[1], size[0]):
+        new_image = cv2.resize(new_image, size, interpolation=cv2.INTER_LINEAR)
+    return new_image
+
+
+# Same as ImageCV2, but resizes with the separable filters below instead of cv2.resize
+class ImageNumpy(ImageCV2):
+    rounds_zoom_size = False
+
+    def resize(self, size, resampling_func, dst=None):
+        if resampling_func == "nearest":
+            new_image = cv2.resize(
+                self.image, size, dst=dst, interpolation=cv2.INTER_NEAREST
+            )
+        else:
+            new_image = resample(self.image, size, resampling_func)
+        return self.__class__(new_image)
+
+    # The zoomed center of the image is resampled directly to the output size,
+    # without resizing the whole image first
+    def zoom_crop_resize(
+        self, zoom, size, resampling_func, dst=None, downscale_resampling_func=None
+    ):
+        if resampling_func == "nearest":
+            return super().zoom_crop_resize(
+                zoom, size, resampling_func, dst, downscale_resampling_func
+            )
+        crop_width, crop_height = self.width / zoom, self.height / zoom
+        resampling_func = get_final_resampling_function(
+            crop_width, size[0], resampling_func, downscale_resampling_func
+        )
+        left, upper = (self.width - crop_width) / 2, (self.height - crop_height) / 2
+        box = (left, upper, left + crop_width, upper + crop_height)
+        return self.__class__(resample(self.image, size, resampling_func, box))
+
+
+# For large downscaling factors, PIL first reduces the image by an integer factor with a fast box filter,
+# the result is indistinguishable from the full resampling for gaps >= 3
+PIL_REDUCING_GAP = 3.0
+
 
 class ImagePIL(ImageWrapper):
+    pix_fmt = "rgb24"
+    rounds_zoom_size = False
+
     def __init__(self, image):
         self.image = image
         self.width = self.image.width
@@ -106,39 +365,305 @@ class ImagePIL(ImageWrapper):
     def load(image_path):
         return ImagePIL(Image.open(image_path))
 
+    @staticmethod
+    def frombytes(data, width, height):
+        return ImagePIL(Image.frombytes("RGB", (width, height), data))
+
     def save(self, image_path):
-        self.image.save(image_path)
+        ext = os.path.splitext(image_path)[1].lower()
+        image = self.image
+        if ext == ".jpg" and image.mode != "RGB":
+            image = image.convert("RGB")
+        image.save(image_path, **PIL_SAVE_PARAMS.get(ext, {}))
+
+    def tobytes(self):
+        image = self.image if self.image.mode == "RGB" else self.image.convert("RGB")
+        return image.tobytes()
+
+    def asarray(self):
+        # Other modes (e.g. palette) cannot be recreated from the array alone
+        image = self.image
+        if image.mode not in ("L", "RGB", "RGBA"):
+            image = image.convert("RGB")
+        return np.asarray(image)
 
-    def resize(self, size, resampling_func):
-        new_image = self.image.resize(size, resampling_func)
+    @staticmethod
+    def fromarray(array):
+        return ImagePIL(Image.fromarray(array))
+
+    def resize(self, size, resampling_func, dst=None):
+        new_image = self.image.resize(
+            size, resampling_func, reducing_gap=PIL_REDUCING_GAP
+        )
         return ImagePIL(new_image)
 
     def crop(self, crop_box):
         new_image = self.image.crop(crop_box)
         return ImagePIL(new_image)
 
+    # The zoomed center of the image is resampled directly to the output size,
+    # without resizing the whole image first
+    def zoom_crop_resize(
+        self, zoom, size, resampling_func, dst=None, downscale_resampling_func=None
+    ):
+        crop_width, crop_height = self.width / zoom, self.height / zoom
+        left, upper = (self.width - crop_width) / 2, (self.height - crop_height) / 2
+        box = (left, upper, left + crop_width, upper + crop_height)
+        resampling_func = get_final_resampling_function(
+            crop_width, size[0], resampling_func, downscale_resampling_func
+        )
+        return ImagePIL(
+            self.image.resize(
+                size, resampling_func, box=box, reducing_gap=PIL_REDUCING_GAP
+            )
+        )
+
     def paste(self, image, x, y):
         self.image.paste(image.image, (x, y))
 
+    def pyr_down(self):
+        return ImagePIL(self.image.reduce(2))
+
+
+# Keeps the images in the GPU memory, requires OpenCV built with CUDA support.
+# The frames are downloaded from the GPU only to be encoded.
+class ImageCUDA(ImageWrapper):
+    pix_fmt = "bgr24"
+
+    def __init__(self, image):
+        super().__init__()
+        self.image = image
+        self.width, self.height = self.image.size()
+
+    @staticmethod
+    def load(image_path):
+        image = cv2.cuda_GpuMat()
+        image.upload(cv2.imread(image_path))
+        return ImageCUDA(image)
+
+    @staticmethod
+    def frombytes(data, width, height):
+        # Frames are saved on the CPU, there is no need to upload them again
+        return ImageCV2.frombytes(data, width, height)
+
+    def save(self, image_path):
+        ImageCV2(self.image.download()).save(image_path)
+
+    def tobytes(self):
+        return self.image.download().tobytes()
+
+    def asarray(self):
+        return self.image.download()
+
+    @staticmethod
+    def fromarray(array):
+        image = cv2.cuda_GpuMat()
+        image.upload(np.ascontiguousarray(array))
+        return ImageCUDA(image)
+
+    def resize(self, size, resampling_func, dst=None):
+        new_image = cv2.cuda.resize(self.image, size, interpolation=resampling_func)
+        return ImageCUDA(new_image)
+
+    def crop(self, crop_box):
+        new_image = cv2.cuda_GpuMat(
+            self.image,
+            (
+                crop_box[0],
+                crop_box[1],
+                crop_box[2] - crop_box[0],
+                crop_box[3] - crop_box[1],
+            ),
+        )
+        return ImageCUDA(new_image)
+
+    def paste(self, image, x, y):
+        image.image.copyTo(
+            cv2.cuda_GpuMat(self.image, (x, y, image.width, image.height))
+        )
+
+    def pyr_down(self):
+        new_image = cv2.cuda.resize(
+            self.image,
+            ((self.width + 1) // 2, (self.height + 1) // 2),
+            interpolation=cv2.INTER_AREA,
+        )
+        return ImageCUDA(new_image)
+
+
+# Pillow-SIMD is a drop-in replacement of Pillow with faster resizing, its versions end with .postN
+def pillow_simd_available():
+    return ".post" in PIL_VERSION
+
+
+def cuda_available():
+    try:
+        return cv2.cuda.getCudaEnabledDeviceCount() > 0
+    except (AttributeError, cv2.error):
+        return False
+
+
+# Separable resampling filters (support, function), the same as used by PIL
+def _bicubic_filter(x, a=-0.5):
+    x = np.abs(x)
+    return np.where(
+        x < 1.0,
+        ((a + 2.0) * x - (a + 3.0)) * x * x + 1,
+        np.where(x < 2.0, (((x - 5) * x + 8) * x - 4) * a, 0.0),
+    )
+
+
+RESAMPLING_FILTERS = {
+    "box": (0.5, lambda x: ((x > -0.5) & (x <= 0.5)).astype(np.float64)),
+    "bilinear": (1.0, lambda x: np.maximum(0.0, 1.0 - np.abs(x))),
+    "hamming": (
+        1.0,
+        lambda x: np.where(
+            np.abs(x) < 1.0, np.sinc(x) * (0.54 + 0.46 * np.cos(pi * x)), 0.0
+        ),
+    ),
+    "bicubic": (2.0, _bicubic_filter),
+    "lanczos": (
+        3.0,
+        lambda x: np.where(np.abs(x) < 3.0, np.sinc(x) * np.sinc(x / 3.0), 0.0),
+    ),
+}
+
+
+# Same precision as used by PIL, the weighted sums of uint8 pixels are still exact in float64
+RESAMPLING_PRECISION_BITS = 22
+
+# Number of output pixels sharing one dense block of weights
+RESAMPLING_BLOCK_SIZE = 16
+
+
+# Returns indices of the input pixels and their weights for each output pixel,
+# the output covers the input range [in_start, in_end), which is the whole input by default.
+def get_resampling_coeffs(in_size, out_size, filter_name, in_start=0.0, in_end=None):
+    if in_end is None:
+        in_end = in_size
+    support, filter_func = RESAMPLING_FILTERS[filter_name]
+    scale = (in_end - in_start) / out_size
+    filter_scale = max(scale, 1.0)
+    support *= filter_scale
+
+    centers = in_start + (np.arange(out_size) + 0.5) * scale
+    starts = np.maximum(np.floor(centers - support + 0.5), 0).astype(np.int64)
+    ends = np.minimum(np.floor(centers + support + 0.5), in_size).astype(np.int64)
+    taps = int(np.ceil(support)) * 2 + 1
+
+    indices = starts[:, None] + np.arange(taps)[None, :]
+    weights = filter_func((indices - centers[:, None] + 0.5) * (1.0 / filter_scale))
+    weights[indices >= ends[:, None]] = 0
+    weights /= weights.sum(axis=1, keepdims=True)
+    indices = np.minimum(indices, in_size - 1)
+    # Fixed point weights, so the pixels are rounded the same way as in PIL
+    weights = np.trunc(
+        weights * (1 << RESAMPLING_PRECISION_BITS) + np.copysign(0.5, weights)
+    )
+    return indices, weights
+
+
+# Groups the coefficients into blocks of consecutive output pixels.
+# Each block depends only on a narrow band of the input pixels [first, last),
+# so it is stored as a small dense matrix and resampled with a single matrix multiplication.
+# The integer weights are stored as float64, so the products are computed with BLAS,
+# but the sums are still exact, the same as with int32 accumulators.
+# The blocks depend only on the sizes, so they are cached and reused by all the frames of the same size.
+@lru_cache(maxsize=256)
+def get_resampling_blocks(in_size, out_size, filter_name, in_start=0.0, in_end=None):
+    indices, weights = get_resampling_coeffs(
+        in_size, out_size, filter_name, in_start, in_end
+    )
+    blocks = []
+    for start in range(0, out_size, RESAMPLING_BLOCK_SIZE):
+        block_indices = indices[start : start + RESAMPLING_BLOCK_SIZE]
+        first, last = block_indices[0, 0], block_indices[-1, -1] + 1
+        matrix = np.zeros((block_indices.shape[0], last - first), dtype=np.float64)
+        np.add.at(
+            matrix,
+            (np.arange(block_indices.shape[0])[:, None], block_indices - first),
+            weights[start : start + RESAMPLING_BLOCK_SIZE],
+        )
+        blocks.append((start, first, last, matrix))
+    return blocks
+
+
+# Resamples the rows of the image, starting from the given row offset
+def _resample_rows(image, blocks, offset=0):
+    start, _, _, matrix = blocks[-1]
+    out_size = start + matrix.shape[0]
+    pixels = image.reshape(image.shape[0], -1).astype(np.float64)
+    out = np.empty((out_size, pixels.shape[1]), dtype=np.float64)
+    for start, first, last, matrix in blocks:
+        np.matmul(
+            matrix,
+            pixels[first - offset : last - offset],
+            out=out[start : start + matrix.shape[0]],
+        )
+    # Similarly to PIL, the result of each pass is rounded back to uint8
+    out += 1 << (RESAMPLING_PRECISION_BITS - 1)
+    out *= 1.0 / (1 << RESAMPLING_PRECISION_BITS)
+    np.floor(out, out=out)
+    np.clip(out, 0, 255, out=out)
+    return out.astype(np.uint8).reshape((out_size,) + image.shape[1:])
+
+
+def _resample_axis(image, blocks, axis, offset=0):
+    if axis == 0:
+        return _resample_rows(image, blocks, offset)
+    # Columns are resampled as the rows of the transposed image
+    out = _resample_rows(np.ascontiguousarray(image.swapaxes(0, 1)), blocks, offset)
+    return np.ascontiguousarray(out.swapaxes(0, 1))
+
+
+# Resamples the box (left, upper, right, lower) of the image, the whole image by default, to the given size
+def resample(image, size, filter_name, box=None):
+    height, width = image.shape[:2]
+    if box is None:
+        box = (0, 0, width, height)
+    # PIL passes the box to the resampling as float32
+    box = tuple(float(np.float32(value)) for value in box)
+    need_horizontal = size[0] != width or box[0] != 0 or box[2] != width
+    need_vertical = size[1] != height or box[1] != 0 or box[3] != height
+    if not need_horizontal and not need_vertical:
+        return image.copy()
+    if need_horizontal:
+        h_blocks = get_resampling_blocks(width, size[0], filter_name, box[0], box[2])
+        if not need_vertical:
+            return _resample_axis(image, h_blocks, 1)
+    if need_vertical:
+        v_blocks = get_resampling_blocks(height, size[1], filter_name, box[1], box[3])
+        if not need_horizontal:
+            return _resample_axis(image, v_blocks, 0)
+
+    # The horizontal pass goes first, as in PIL, the intermediate image is clipped to uint8,
+    # so the order changes the results of the filters with negative lobes.
+    # The first pass processes only the rows needed by the second one.
+    first_row, last_row = v_blocks[0][1], v_blocks[-1][2]
+    out = _resample_axis(image[first_row:last_row], h_blocks, 1)
+    return _resample_axis(out, v_blocks, 0, first_row)
+
 
 # Easing and resampling functions
 
 
+# Easing functions work both on single values and numpy arrays,
+# so the whole zoom schedule can be evaluated at once
+
+
 # Gennerat family of power-based easing functions
 def get_ease_pow_in(power, **kwargs):
-    return lambda x: pow(x, power)
+    return lambda x: x**power
 
 
 def get_ease_pow_out(power, **kwargs):
-    return lambda x: 1 - pow(1 - x, power)
+    return lambda x: 1 - (1 - x) ** power
 
 
 def get_ease_pow_in_out(power, **kwargs):
-    return (
-        lambda x: pow(2, power - 1) * pow(x, power)
-        if x < 0.5
-        else 1 - pow(-2 * x + 2, power) / 2
-    )
+    scale = 2 ** (power - 1)
+    return lambda x: np.where(x < 0.5, scale * x**power, 1 - (-2 * x + 2) ** power / 2)
 
 
 # Returns an linear easing function with in and out ease
@@ -149,14 +674,16 @@ def get_linear_with_in_out_ease(ease_duration, **kwargs):
     ease_duration_scale = 1 / ease_duration
 
     def linear_ease_in_out(x):
-        if x < ease_duration:
-            return (x * ease_duration_scale) ** 2 / ease_duration_scale / 2
-        elif x > (1 - ease_duration):
-            return 1 - ((1 - x) * ease_duration_scale) ** 2 / ease_duration_scale / 2
-        else:
-            return (x - ease_duration) * (1 - ease_duration) / (
-                1 - 2 * ease_duration
-            ) + ease_duration / 2
+        return np.where(
+            x < ease_duration,
+            (x * ease_duration_scale) ** 2 / ease_duration_scale / 2,
+            np.where(
+                x > (1 - ease_duration),
+                1 - ((1 - x) * ease_duration_scale) ** 2 / ease_duration_scale / 2,
+                (x - ease_duration) * (1 - ease_duration) / (1 - 2 * ease_duration)
+                + ease_duration / 2,
+            ),
+        )
 
     return linear_ease_in_out
 
@@ -164,9 +691,9 @@ def get_linear_with_in_out_ease(ease_duration, **kwargs):
 EASING_FUNCTIONS = {
     "linear": lambda x: x,
     "linearWithInOutEase": get_linear_with_in_out_ease,
-    "easeInSine": lambda x: 1 - cos((x * pi) / 2),
-    "easeOutSine": lambda x: sin((x * pi) / 2),
-    "easeInOutSine": lambda x: -(cos(pi * x) - 1) / 2,
+    "easeInSine": lambda x: 1 - np.cos((x * pi) / 2),
+    "easeOutSine": lambda x: np.sin((x * pi) / 2),
+    "easeInOutSine": lambda x: -(np.cos(pi * x) - 1) / 2,
     "easeInQuad": get_ease_pow_in(power=2),
     "easeOutQuad": get_ease_pow_out(power=2),
     "easeInOutQuad": get_ease_pow_in_out(power=2),
@@ -177,16 +704,25 @@ EASING_FUNCTIONS = {
     "easeOutPow": get_ease_pow_out,
     "easeInOutPow": get_ease_pow_in_out,
 }
+# These functions create the easing function for the given power and ease duration
+EASING_FUNCTION_FACTORIES = (
+    get_linear_with_in_out_ease,
+    get_ease_pow_in,
+    get_ease_pow_out,
+    get_ease_pow_in_out,
+)
 DEFAULT_EASING_KEY = "easeInOutSine"
 DEFAULT_EASING_POWER = 1.5
 DEFAULT_EASE_DURATION = 0.02
 
 
+# The easing functions are cached, so repeated runs with the same parameters reuse them
+@lru_cache(maxsize=None)
 def get_easing_function(easing, power, ease_duration):
     easing_func = EASING_FUNCTIONS.get(easing, None)
     if easing_func is None:
         raise ValueError(f"Unsupported easing function: {easing}")
-    if easing_func.__code__.co_varnames[0] != "x":
+    if easing_func in EASING_FUNCTION_FACTORIES:
         easing_func = easing_func(power=power, ease_duration=ease_duration)
     return easing_func
 
@@ -195,6 +731,7 @@ def get_easing_function(easing, power, ease_duration):
 IMAGE_CLASSES = {
     "pil": ImagePIL,
     "cv2": ImageCV2,
+    "numpy": ImageNumpy,
 }
 DEFAULT_IMAGE_ENGINE = "cv2"
 RESAMPLING_FUNCTIONS_CV2 = {
@@ -213,17 +750,65 @@ RESAMPLING_FUNCTIONS_PIL = {
     "bicubic": Image.Resampling.BICUBIC,
     "lanczos": Image.Resampling.LANCZOS,
 }
+RESAMPLING_FUNCTIONS_NUMPY = {
+    "nearest": "nearest",
+    "box": "box",
+    "bilinear": "bilinear",
+    "hamming": "hamming",
+    "bicubic": "bicubic",
+    "lanczos": "lanczos",
+}
+# CUDA resize doesn't support Lanczos interpolation, bicubic is the closest one
+RESAMPLING_FUNCTIONS_CUDA = {
+    "nearest": cv2.INTER_NEAREST,
+    "box": cv2.INTER_AREA,
+    "bilinear": cv2.INTER_LINEAR,
+    "hamming": cv2.INTER_LINEAR,
+    "bicubic": cv2.INTER_CUBIC,
+    "lanczos": cv2.INTER_CUBIC,
+}
 RESAMPLING_FUNCTIONS = {
     "pil": RESAMPLING_FUNCTIONS_PIL,
     "cv2": RESAMPLING_FUNCTIONS_CV2,
+    "numpy": RESAMPLING_FUNCTIONS_NUMPY,
 }
+
+# The CUDA engine is available only if OpenCV was built with CUDA and a device is present
+if cuda_available():
+    IMAGE_CLASSES["cuda"] = ImageCUDA
+    RESAMPLING_FUNCTIONS["cuda"] = RESAMPLING_FUNCTIONS_CUDA
 DEFAULT_RESAMPLING_KEY = "lanczos"
 
 
+def get_image_class(image_engine):
+    image_class = IMAGE_CLASSES.get(image_engine, None)
+    if image_class is None:
+        raise ValueError(f"Unsupported image engine: {image_engine}")
+
+    return image_class
+
+
+# Box filter (area averaging) is much faster than the others for large downscaling factors,
+# and the difference in quality is not visible
+DOWNSCALE_RESAMPLING_KEY = "box"
+DOWNSCALE_RESAMPLING_MAX_SCALE = 0.5
+
+
+def get_final_resampling_function(
+    in_width, out_width, resampling_func, downscale_resampling_func=None
+):
+    if (
+        downscale_resampling_func is not None
+        and out_width < in_width * DOWNSCALE_RESAMPLING_MAX_SCALE
+    ):
+        return downscale_resampling_func
+    return resampling_func
+
+
 def get_resampling_function(resampling, image_engine):
     available_resampling_func = RESAMPLING_FUNCTIONS.get(image_engine, None)
     if available_resampling_func is None:
-        raise ValueError(f"Unsupported image engine function: {resampling}")
+        raise ValueError(f"Unsupported image engine: {image_engine}")
 
     resampling_func = available_resampling_func.get(resampling, None)
     if resampling_func is None:
@@ -241,6 +826,14 @@ def zoom_out_log(easing_func, i, num_frames, num_images):
     return (1 - easing_func(i / (num_frames - 1))) * num_images
 
 
+ZOOM_LOG_FUNCTIONS = {
+    "in": (zoom_in_log,),
+    "out": (zoom_out_log,),
+    "inout": (zoom_in_log, zoom_out_log),
+    "outin": (zoom_out_log, zoom_in_log),
+}
+
+
 def zoom_in(zoom, easing_func, i, num_frames, num_images):
     return zoom ** zoom_in_log(easing_func, i, num_frames, num_images)
 
@@ -255,18 +848,21 @@ def get_px_or_fraction(value, reference_value):
     return int(value)
 
 
-def read_images(image_paths, logger, image_engine=DEFAULT_IMAGE_ENGINE):
-    image_class = IMAGE_CLASSES.get(image_engine, None)
-    if image_class is None:
-        raise ValueError(f"Unsupported image engine function: {image_class}")
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
 
-    images = []
-    for image_path in image_paths:
-        if not image_path.lower().endswith((".png", ".jpg", ".jpeg", ".webp")):
-            logger(f"Unsupported file type: {image_path}, skipping")
-            continue
-        image = image_class.load(image_path)
-        images.append(image)
+
+def read_images(
+    image_paths, image_engine=DEFAULT_IMAGE_ENGINE, executor=None, n_jobs=None
+):
+    image_class = get_image_class(image_engine)
+
+    # Decoders release the GIL, so images can be loaded in parallel using threads,
+    # unless the executor is provided by the user
+    if isinstance(executor, Executor):
+        images = list(executor.map(image_class.load, image_paths))
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as images_executor:
+            images = list(images_executor.map(image_class.load, image_paths))
 
     if len(images) < 2:
         raise ValueError("At least two images are required to create a zoom video")
@@ -283,21 +879,60 @@ def save_images(images, output_dir, files_prefix="", start_i=0):
         image.save(image_path)
 
 
-def get_image_paths(input_paths):
-    image_paths = []
+# Files with unsupported extensions are skipped, both the given ones and the ones found in the directories
+def get_image_paths(input_paths, logger):
+    file_paths = []
     for path in input_paths:
         if hasattr(path, "name"):
-            image_paths.append(path.name)
+            file_paths.append(path.name)
         elif os.path.isfile(path):
-            image_paths.append(path)
+            file_paths.append(path)
         elif os.path.isdir(path):
-            for subpath in sorted(os.listdir(path)):
-                image_paths.append(os.path.join(path, subpath))
+            # scandir gets the file types together with the names, so no additional stat calls are needed
+            with os.scandir(path) as entries:
+                file_paths.extend(
+                    sorted(entry.path for entry in entries if entry.is_file())
+                )
         else:
             raise ValueError(f"Unsupported file type: {path}, skipping")
+
+    image_paths = []
+    for file_path in file_paths:
+        if not file_path.lower().endswith(IMAGE_EXTENSIONS):
+            logger(f"Unsupported file type: {file_path}, skipping")
+            continue
+        image_paths.append(file_path)
     return image_paths
 
 
+# Path together with the modification time and size of the file, so changes of the file can be detected
+def get_file_signature(path):
+    stat = os.stat(path)
+    return f"{path}:{stat.st_mtime_ns}:{stat.st_size}"
+
+
+def get_frame_path(tmp_dir_hash, i, frame_format=DEFAULT_FRAME_FORMAT):
+    return os.path.join(tmp_dir_hash, f"{i:06d}.{frame_format}")
+
+
+# Returns the number of consecutive frames from the beginning that are already saved,
+# the directory is listed once instead of checking each frame separately
+def get_num_saved_frames(tmp_dir_hash, frame_format=DEFAULT_FRAME_FORMAT):
+    if not os.path.isdir(tmp_dir_hash):
+        return 0
+    suffix = f".{frame_format}"
+    with os.scandir(tmp_dir_hash) as entries:
+        saved_frames = {
+            int(entry.name[: -len(suffix)])
+            for entry in entries
+            if entry.name.endswith(suffix) and entry.name[: -len(suffix)].isdigit()
+        }
+    num_saved_frames = 0
+    while num_saved_frames in saved_frames:
+        num_saved_frames += 1
+    return num_saved_frames
+
+
 def get_sizes(image, width, height, margin):
     width = get_px_or_fraction(width, image.width)
     height = get_px_or_fraction(height, image.height)
@@ -315,6 +950,10 @@ def images_reverse(images, direction, reverse_images):
 
 def blend_images(images, margin, zoom, resampling_func):
     num_images = len(images) - 1
+
+    # Each image is pasted into the center of the previous image zoomed in.
+    # The upscaled previous images are kept for the second pass.
+    images_resized = [None] * (num_images + 1)
     for i in range(1, num_images + 1):
         inner_image = images[i]
         outer_image = images[i - 1]
@@ -322,23 +961,35 @@ def blend_images(images, margin, zoom, resampling_func):
             (margin, margin, inner_image.width - margin, inner_image.height - margin)
         )
 
-        image = outer_image.zoom_crop(zoom, resampling_func)
+        image_resized = outer_image.resize_scale(zoom, resampling_func)
+        image = image_resized.crop_center(outer_image.width, outer_image.height)
         image.paste(inner_image, margin, margin)
         images[i] = image
+        images_resized[i] = image_resized
 
-    image_resized = images[num_images].resize_scale(zoom, resampling_func)
+    # The next image, with all the following images already pasted in,
+    # is pasted into the center of each upscaled image from the first pass.
+    # The inner image is composed at the original size,
+    # so the upscaled images never need to be upscaled again or downscaled back.
+    inner_image = images[num_images]
     for i in range(num_images, 0, -1):
-        inner_image = image_resized
-        next_image_resized = images[i - 1].resize_scale(zoom, resampling_func)
-        image = next_image_resized
-        inner_image = inner_image.resize_scale(1.0 / zoom, resampling_func)
-
+        image = images_resized[i]
+        images_resized[i] = None
         image.paste(
             inner_image,
             int((image.width - inner_image.width) / 2),
             int((image.height - inner_image.height) / 2),
         )
-        image_resized = next_image_resized
+
+        # The first image is kept as it is, other ones are replaced by the upscaled versions
+        if i > 1:
+            inner_image_resized = inner_image.resize_scale(1.0 / zoom, resampling_func)
+            inner_image = images[i - 1]
+            inner_image.paste(
+                inner_image_resized,
+                int((inner_image.width - inner_image_resized.width) / 2),
+                int((inner_image.height - inner_image_resized.height) / 2),
+            )
         images[i] = image
 
     return images
@@ -351,81 +1002,487 @@ def resize_images(images, resize_factor, resampling_func):
     return images
 
 
+# Halves the images as long as the first one stays at least the given size,
+# so the images larger than needed are cheaper to blend and take less memory.
+# All the images are halved the same number of times, so the margin can be scaled the same way for all of them.
+def reduce_images(images, min_width, min_height):
+    width, height = images[0].width, images[0].height
+    num_halvings = 0
+    while width // 2 >= min_width and height // 2 >= min_height:
+        width, height = (width + 1) // 2, (height + 1) // 2
+        num_halvings += 1
+
+    for i, image in enumerate(images):
+        for _ in range(num_halvings):
+            image = image.pyr_down()
+        images[i] = image
+    return images
+
+
+# Each image is stored together with its versions downscaled by the factor of 2,
+# as long as they are not smaller than the given size
+def build_pyramids(images, min_width, min_height):
+    pyramids = []
+    for image in images:
+        pyramid = [image]
+        while (
+            pyramid[-1].width // 2 >= min_width
+            and pyramid[-1].height // 2 >= min_height
+        ):
+            pyramid.append(pyramid[-1].pyr_down())
+        pyramids.append(pyramid)
+    return pyramids
+
+
+# Returns the index of the smallest level of the pyramid that is not smaller than the given size
+def get_pyramid_level_index(pyramid, min_width, min_height):
+    level_idx = 0
+    for next_level in pyramid[1:]:
+        if next_level.width < min_width or next_level.height < min_height:
+            break
+        level_idx += 1
+    return level_idx
+
+
+def select_pyramid_level(pyramid, min_width, min_height):
+    return pyramid[get_pyramid_level_index(pyramid, min_width, min_height)]
+
+
+# Returns the id of each frame, frames with the same id are the same, so they need to be generated only once.
+# The frames are the same if they are cropped from the same level with the same zoomed size,
+# which often happens for slow zooms and at the ends of the easing.
+def get_frame_ids(pyramids, image_idx, local_zoom, width, height, pyramid_scale=1.0):
+    if not pyramids[0][0].rounds_zoom_size:
+        keys = np.stack([image_idx, local_zoom], axis=1)
+    else:
+        keys = np.empty((len(image_idx), 4), dtype=np.int64)
+        for i, (idx, zoom) in enumerate(zip(image_idx, local_zoom)):
+            pyramid = pyramids[idx]
+            level_idx = get_pyramid_level_index(
+                pyramid,
+                width * zoom * pyramid_scale,
+                height * zoom * pyramid_scale,
+            )
+            level = pyramid[level_idx]
+            keys[i] = (
+                idx,
+                level_idx,
+                int(level.width * zoom),
+                int(level.height * zoom),
+            )
+    return np.unique(keys, axis=0, return_inverse=True)[1].reshape(-1)
+
+
+# Returns the index of the image and its local zoom for each frame of the video.
+# It is computed once before generating the frames, so the workers only need to look them up.
+def get_zoom_schedule(
+    direction, easing_func, num_frames, num_frames_half, num_images, zoom, zoom_steps=0
+):
+    # Directions combining both zooms use each function for one half of the frames
+    zoom_log_funcs = ZOOM_LOG_FUNCTIONS.get(direction, None)
+    if zoom_log_funcs is None:
+        raise ValueError(f"Unsupported direction: {direction}")
+
+    frames = np.arange(num_frames)
+    if len(zoom_log_funcs) == 1:
+        zoom_log = zoom_log_funcs[0](easing_func, frames, num_frames, num_images)
+    else:
+        first_func, second_func = zoom_log_funcs
+        zoom_log = np.concatenate(
+            (
+                first_func(
+                    easing_func,
+                    frames[:num_frames_half],
+                    num_frames_half,
+                    num_images,
+                ),
+                second_func(
+                    easing_func,
+                    frames[num_frames_half:] - num_frames_half,
+                    num_frames_half,
+                    num_images,
+                ),
+            )
+        )
+
+    zoom_log = np.asarray(zoom_log, dtype=np.float64)
+    image_idx = np.ceil(zoom_log).astype(np.int32)
+    local_zoom_log = zoom_log - image_idx + 1
+    if zoom_steps > 0:
+        local_zoom_log = np.round(local_zoom_log * zoom_steps) / zoom_steps
+    local_zoom = np.power(zoom, local_zoom_log)
+
+    # The first image is used without zooming, local zoom of 1 is not reached otherwise
+    first_image = zoom_log == 0.0
+    image_idx[first_image] = 0
+    local_zoom[first_image] = 1.0
+
+    return image_idx, local_zoom
+
+
 def process_frame(
-    i,
-    images,
-    direction,
-    easing_func,
-    num_frames,
-    num_frames_half,
-    num_images,
-    zoom,
+    pyramids,
+    image_idx,
+    local_zoom,
     width,
     height,
     resampling_func,
-    tmp_dir_hash,
+    pyramid_scale=1.0,
+    dst=None,
+    downscale_resampling_func=None,
 ):
-    if direction == "in":
-        current_zoom_log = zoom_in_log(easing_func, i, num_frames, num_images)
-    elif direction == "out":
-        current_zoom_log = zoom_out_log(easing_func, i, num_frames, num_images)
-    elif direction == "inout":
-        if i < num_frames_half:
-            current_zoom_log = zoom_in_log(easing_func, i, num_frames_half, num_images)
-        else:
-            current_zoom_log = zoom_out_log(
-                easing_func, i - num_frames_half, num_frames_half, num_images
-            )
-    elif direction == "outin":
-        if i < num_frames_half:
-            current_zoom_log = zoom_out_log(easing_func, i, num_frames_half, num_images)
-        else:
-            current_zoom_log = zoom_in_log(
-                easing_func, i - num_frames_half, num_frames_half, num_images
-            )
-    else:
-        raise ValueError(f"Unsupported direction: {direction}")
+    # The zoomed crop of the selected level still needs to be at least pyramid_scale times larger than the frame
+    frame = select_pyramid_level(
+        pyramids[image_idx],
+        width * local_zoom * pyramid_scale,
+        height * local_zoom * pyramid_scale,
+    )
+    return frame.zoom_crop_resize(
+        local_zoom, (width, height), resampling_func, dst, downscale_resampling_func
+    )
 
-    current_image_idx = ceil(current_zoom_log)
-    local_zoom = zoom ** (current_zoom_log - current_image_idx + 1)
 
-    if current_zoom_log == 0.0:
-        frame = images[0]
-    else:
-        frame = images[current_image_idx]
-        frame = frame.zoom_crop(local_zoom, resampling_func)
+# Frame workers
+# The state (images and video parameters) is set once per worker by init_frame_worker,
+# so only the frame index needs to be sent to the worker for each frame.
+_frame_worker_state = {}
+
+# Each worker thread writes its frames into its own reusable buffer
+_frame_buffers = threading.local()
+
+
+def get_frame_buffer(width, height):
+    buffer = getattr(_frame_buffers, "buffer", None)
+    if buffer is None or buffer.shape != (height, width, 3):
+        buffer = np.empty((height, width, 3), dtype=np.uint8)
+        _frame_buffers.buffer = buffer
+    return buffer
+
+
+# The I420 planes of the frame take 1.5 rows per row of the frame
+def get_yuv420_buffer(width, height):
+    buffer = getattr(_frame_buffers, "yuv420_buffer", None)
+    if buffer is None or buffer.shape != (height * 3 // 2, width):
+        buffer = np.empty((height * 3 // 2, width), dtype=np.uint8)
+        _frame_buffers.yuv420_buffer = buffer
+    return buffer
+
+
+# Returns a view of the given shape into the scratch buffer of the worker thread,
+# the buffer grows to the largest requested size and it is reused by all the following calls
+def get_scratch_buffer(shape):
+    size = int(np.prod(shape))
+    scratch = getattr(_frame_buffers, "scratch", None)
+    if scratch is None or scratch.size < size:
+        scratch = np.empty(size, dtype=np.uint8)
+        _frame_buffers.scratch = scratch
+    return scratch[:size].reshape(shape)
+
+
+def share_images(pyramids):
+    # Copy all the image pyramids into a single block of shared memory,
+    # so worker processes can map them instead of copying.
+    # Each image is stored under an offset aligned to the cache line size.
+    layout = []
+    size = 0
+    for pyramid in pyramids:
+        pyramid_layout = []
+        for image in pyramid:
+            array = image.asarray()
+            pyramid_layout.append((size, array.shape, array.dtype.str))
+            size += (array.nbytes + 63) // 64 * 64
+        layout.append(pyramid_layout)
+
+    shm = shared_memory.SharedMemory(create=True, size=max(1, size))
+    for pyramid, pyramid_layout in zip(pyramids, layout):
+        for image, (offset, shape, dtype) in zip(pyramid, pyramid_layout):
+            array = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+            array[:] = image.asarray()
+    return shm, layout
+
+
+def release_shared_images(shm):
+    if shm is not None:
+        shm.close()
+        shm.unlink()
+
+
+def init_frame_worker(state, shared_images_specs=None):
+    # Workers already run in parallel, OpenCV's own threads would only oversubscribe the cores
+    cv2.setNumThreads(1)
+
+    _frame_worker_state.clear()
+    _frame_worker_state.update(state)
+    if shared_images_specs is not None:
+        name, layout = shared_images_specs
+        shm = shared_memory.SharedMemory(name=name)
+        image_class = get_image_class(state["image_engine"])
+        _frame_worker_state["pyramids"] = [
+            [
+                image_class.fromarray(
+                    np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+                )
+                for offset, shape, dtype in pyramid_layout
+            ]
+            for pyramid_layout in layout
+        ]
+        _frame_worker_state["shm"] = (
+            shm  # Keep the reference, so the memory stays mapped
+        )
 
-    frame = frame.resize((width, height), resampling_func)
-    frame_path = os.path.join(tmp_dir_hash, f"{i:06d}.png")
-    frame.save(frame_path)
 
+def process_frame_in_worker(i, state=None):
+    # Returns raw bytes of the frame
+    if state is None:
+        state = _frame_worker_state
+
+    frame = process_frame(
+        state["pyramids"],
+        state["image_idx"][i],
+        state["local_zoom"][i],
+        state["width"],
+        state["height"],
+        state["resampling_func"],
+        state["pyramid_scale"],
+        dst=get_frame_buffer(state["width"], state["height"]),
+        downscale_resampling_func=state["downscale_resampling_func"],
+    )
+    # The buffer is reused by the next frame, so the frame is copied before returning
+    if state["yuv420"]:
+        return frame.toyuv420bytes()
+    return frame.tobytes()
 
-def create_video_clip(output_path, fps, num_frames, tmp_dir_hash, audio_path, threads):
-    image_files = [
-        os.path.join(tmp_dir_hash, f"{i:06d}.png") for i in range(num_frames)
-    ]
-    video_clip = ImageSequenceClip(image_files, fps=fps)
-    video_write_kwargs = {"codec": "libx264", "threads": threads}
 
-    # Add audio
+def process_frames_chunk(process_frame_func, frames):
+    return [process_frame_func(i) for i in frames]
+
+
+# Returns the runs of consecutive frames with the same id as lists of the first frame and the length of the run
+def get_frame_runs(frames, frame_ids):
+    runs = []
+    for i in frames:
+        if runs and frame_ids[i] == frame_ids[runs[-1][0]]:
+            runs[-1][1] += 1
+        else:
+            runs.append([i, 1])
+    return runs
+
+
+# Same as executor.map, but only max_pending chunks of frames are submitted at once,
+# so the generated frames don't pile up in the memory when the encoding is slower than the generation.
+# Only the first frame of each run (see get_frame_runs) is generated, it is repeated for the rest of the run.
+def map_frames(executor, process_frame_func, runs, chunksize=1, max_pending=1):
+    pending = deque()
+
+    def get_chunk_frames(future, chunk_runs):
+        for frame_bytes, (_, run_length) in zip(future.result(), chunk_runs):
+            for _ in range(run_length):
+                yield frame_bytes
+
+    try:
+        for start in range(0, len(runs), chunksize):
+            chunk_runs = runs[start : start + chunksize]
+            chunk = [i for i, _ in chunk_runs]
+            future = executor.submit(process_frames_chunk, process_frame_func, chunk)
+            pending.append((future, chunk_runs))
+            if len(pending) >= max_pending:
+                yield from get_chunk_frames(*pending.popleft())
+        while pending:
+            yield from get_chunk_frames(*pending.popleft())
+    finally:
+        for future, _ in pending:
+            future.cancel()
+
+
+# Returns the ffmpeg command encoding the given video input (and audio if provided) with libx264
+def get_ffmpeg_cmd(
+    input_args, output_path, width, height, audio_path=None, duration=None, threads=0
+):
+    cmd = [get_setting("FFMPEG_BINARY"), "-y", "-loglevel", "error"] + input_args
     if audio_path:
-        audio_clip = AudioFileClip(audio_path)
-        audio_clip = audio_clip.subclip(0, video_clip.end)
-        video_clip = video_clip.set_audio(audio_clip)
-        video_write_kwargs["audio_codec"] = "aac"
+        if duration is not None:
+            cmd.extend(["-t", str(duration)])
+        cmd.extend(["-i", audio_path, "-c:a", "aac"])
+    cmd.extend(["-c:v", "libx264", "-preset", "veryfast", "-threads", str(threads)])
+    # Similar to moviepy, yuv420p is used only if it is supported by the frame size
+    if width % 2 == 0 and height % 2 == 0:
+        cmd.extend(["-pix_fmt", "yuv420p"])
+    cmd.append(output_path)
+    return cmd
+
+
+# Encodes the raw frames written to stdin of the ffmpeg process,
+# so the frames don't need to be saved to the disk.
+# The frames are passed to ffmpeg by a separate thread through a bounded queue,
+# so the encoding overlaps with the generation of the next frames.
+class FFmpegWriter(object):
+    def __init__(
+        self,
+        output_path,
+        width,
+        height,
+        fps,
+        pix_fmt,
+        audio_path=None,
+        duration=None,
+        threads=0,
+        queue_size=64,
+    ):
+        cmd = get_ffmpeg_cmd(
+            [
+                "-f",
+                "rawvideo",
+                "-pix_fmt",
+                pix_fmt,
+                "-s",
+                f"{width}x{height}",
+                "-r",
+                str(fps),
+                "-i",
+                "-",
+            ],
+            output_path,
+            width,
+            height,
+            audio_path,
+            duration,
+            threads,
+        )
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+        self.error = None
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self._write_frames, daemon=True)
+        self.thread.start()
+
+    def _write_frames(self):
+        while True:
+            frame_bytes = self.queue.get()
+            if frame_bytes is None:
+                break
+            # After an error, keep draining the queue, so the producer is not blocked
+            if self.error is None:
+                try:
+                    self.proc.stdin.write(frame_bytes)
+                except OSError as e:
+                    self.error = e
+
+    def write(self, frame_bytes):
+        if self.error is not None:
+            raise RuntimeError("ffmpeg stopped accepting frames") from self.error
+        self.queue.put(frame_bytes)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        if self.proc.wait() != 0:
+            raise RuntimeError(
+                f"ffmpeg failed to write the video with exit code {self.proc.returncode}"
+            )
+
+    def kill(self):
+        self.proc.kill()
+        self.queue.put(None)
+        self.thread.join()
+        self.proc.wait()
+
+
+# Saves the raw frames to the tmp dir in background threads,
+# so the frame workers don't wait for the encoding and writing of the files.
+# Has the same interface as FFmpegWriter, the frames are expected in order.
+class FramesSaver(object):
+    def __init__(
+        self,
+        tmp_dir_hash,
+        frame_format,
+        image_class,
+        width,
+        height,
+        start_frame=0,
+        threads=None,
+        queue_size=64,
+    ):
+        self.tmp_dir_hash = tmp_dir_hash
+        self.frame_format = frame_format
+        self.image_class = image_class
+        self.width = width
+        self.height = height
+        self.next_frame = start_frame
+        self.queue_size = queue_size
+        self.pending = deque()
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def _save_frame(self, i, frame_bytes):
+        frame = self.image_class.frombytes(frame_bytes, self.width, self.height)
+        frame.save(get_frame_path(self.tmp_dir_hash, i, self.frame_format))
+
+    def write(self, frame_bytes):
+        # Wait for the oldest frame if the queue is full, this also raises its errors
+        if len(self.pending) >= self.queue_size:
+            self.pending.popleft().result()
+        self.pending.append(
+            self.executor.submit(self._save_frame, self.next_frame, frame_bytes)
+        )
+        self.next_frame += 1
+
+    def close(self):
+        try:
+            while self.pending:
+                self.pending.popleft().result()
+        finally:
+            self.executor.shutdown()
 
-    video_clip.write_videofile(
+    def kill(self):
+        self.executor.shutdown(cancel_futures=True)
+        self.pending.clear()
+
+
+# Encodes the frames saved in the tmp dir in a single ffmpeg pass, together with the audio
+def create_video_clip(
+    output_path,
+    fps,
+    num_frames,
+    tmp_dir_hash,
+    audio_path,
+    threads,
+    width,
+    height,
+    frame_format=DEFAULT_FRAME_FORMAT,
+):
+    cmd = get_ffmpeg_cmd(
+        [
+            "-nostats",
+            "-progress",
+            "pipe:1",
+            "-framerate",
+            str(fps),
+            "-start_number",
+            "0",
+            # The saved frames are decoded in parallel, each thread decodes a different frame
+            "-threads",
+            str(threads),
+            "-thread_type",
+            "frame",
+            "-i",
+            os.path.join(tmp_dir_hash, f"%06d.{frame_format}"),
+        ],
         output_path,
-        logger=TqdmProgressBarLogger(
-            bars={
-                "t": {
-                    "title": "Writing the movie file",
-                    "total": num_frames,
-                    "message": None,
-                    "index": -1,
-                }
-            },
-            print_messages=False,
-        ),
-        **video_write_kwargs,
+        width,
+        height,
+        audio_path,
+        num_frames / fps,
+        threads,
     )
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    with tqdm(total=num_frames, desc="Writing the movie file") as progress_bar:
+        for line in proc.stdout:
+            if line.startswith("frame="):
+                progress_bar.update(int(line[len("frame=") :]) - progress_bar.n)
+    if proc.wait() != 0:
+        raise RuntimeError(
+            f"ffmpeg failed to write the video with exit code {proc.returncode}"
+        )
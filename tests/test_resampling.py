@@ -0,0 +1,97 @@
+import cv2
+import numpy as np
+import pytest
+from PIL import Image
+
+from helpers import resample, warp_zoom_crop
+
+PIL_FILTERS = {
+    "box": Image.BOX,
+    "bilinear": Image.BILINEAR,
+    "hamming": Image.HAMMING,
+    "bicubic": Image.BICUBIC,
+    "lanczos": Image.LANCZOS,
+}
+
+
+def get_noise_image(width, height):
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+
+# Smooth image, so the resampling differences come from the geometry, not from the aliasing
+def get_smooth_image(width, height):
+    y, x = np.mgrid[0:height, 0:width].astype(np.float64)
+    channels = [
+        127 + 100 * np.sin(x / 13 + y / 29),
+        127 + 100 * np.cos(x / 21 - y / 11),
+        127 + 60 * np.sin((x + y) / 17),
+    ]
+    return np.stack(channels, axis=-1).astype(np.uint8)
+
+
+@pytest.mark.parametrize("filter_name", list(PIL_FILTERS.keys()))
+@pytest.mark.parametrize("size", [(50, 40), (131, 60), (64, 200), (260, 190)])
+@pytest.mark.parametrize("box", [None, (10.5, 7.25, 100.3, 80.9)])
+def test_resample_matches_pil(filter_name, size, box):
+    image = get_noise_image(131, 97)
+    result = resample(image, size, filter_name, box)
+    expected = np.asarray(
+        Image.fromarray(image).resize(size, PIL_FILTERS[filter_name], box=box)
+    )
+    assert result.shape == expected.shape
+    assert np.abs(result.astype(np.int32) - expected).max() <= 1
+
+
+# Some pixels, mostly with fractional boxes, are rounded differently than in PIL and differ by 1
+@pytest.mark.parametrize("seed", range(100))
+def test_resample_matches_pil_random(seed):
+    rng = np.random.default_rng(seed)
+    width, height = (int(value) for value in rng.integers(8, 160, 2))
+    image = get_noise_image(width, height)
+    size = tuple(int(value) for value in rng.integers(4, 240, 2))
+    filter_name = list(PIL_FILTERS.keys())[seed % len(PIL_FILTERS)]
+    box = None
+    if seed % 2:
+        left, upper = rng.uniform(0, width / 2), rng.uniform(0, height / 2)
+        box = (
+            left,
+            upper,
+            rng.uniform(left + 1, width),
+            rng.uniform(upper + 1, height),
+        )
+    result = resample(image, size, filter_name, box)
+    expected = np.asarray(
+        Image.fromarray(image).resize(size, PIL_FILTERS[filter_name], box=box)
+    )
+    assert result.shape == expected.shape
+    assert np.abs(result.astype(np.int32) - expected).max() <= 1
+
+
+# The previous implementation of zoom_crop_resize of the cv2 image engine
+def zoom_crop_resize_reference(image, zoom_size, size, interpolation):
+    height, width = image.shape[:2]
+    zoomed = cv2.resize(image, zoom_size, interpolation=interpolation)
+    x, y = int((zoom_size[0] - width) / 2), int((zoom_size[1] - height) / 2)
+    cropped = zoomed[y : y + height, x : x + width]
+    return cv2.resize(cropped, size, interpolation=interpolation)
+
+
+@pytest.mark.parametrize(
+    "interpolation", [cv2.INTER_LINEAR, cv2.INTER_CUBIC, cv2.INTER_LANCZOS4]
+)
+@pytest.mark.parametrize("zoom", [1.1, 1.37, 1.9])
+@pytest.mark.parametrize("size", [(160, 120), (320, 240), (400, 300)])
+def test_warp_zoom_crop_matches_resize_crop_resize(interpolation, zoom, size):
+    width, height = 320, 240
+    image = get_smooth_image(width, height)
+    zoom_size = (int(width * zoom), int(height * zoom))
+    result = warp_zoom_crop(image, zoom_size, size, interpolation)
+    expected = zoom_crop_resize_reference(image, zoom_size, size, interpolation)
+    assert result.shape == expected.shape
+
+    # The borders are extrapolated differently, shifting the image by half a pixel
+    # would change the pixels inside by about 4 levels
+    diff = np.abs(result.astype(np.int32) - expected)[2:-2, 2:-2]
+    assert diff.max() <= 2
+    assert diff.mean() < 0.5
@@ -23,13 +23,13 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import concurrent
 import os
 import shutil
 import time
-from concurrent.futures import ThreadPoolExecutor
-from hashlib import md5
-from multiprocessing import cpu_count
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from hashlib import blake2b
+from multiprocessing import cpu_count, get_all_start_methods, get_context
 import click
 from tqdm import tqdm
 
@@ -141,6 +141,22 @@ VERSION = "0.4.0"
     "when using very slow zooms. They increase the duration of the rendering.",
     show_default=True,
 )
+@click.option(
+    "--final-resampling-auto/--no-final-resampling-auto",
+    default=True,
+    help="Use the fast box resampling instead of the selected one, "
+    "when the frame is downscaled more than 2x in the final resize.",
+    show_default=True,
+)
+@click.option(
+    "--zoom-steps",
+    type=int,
+    default=0,
+    help="Number of zoom levels between two consecutive images the frames are rounded to. "
+    "Consecutive frames with the same zoom level are generated only once, which is faster for slow zooms, "
+    "but the animation may be less smooth. 0 means no rounding.",
+    show_default=True,
+)
 @click.option(
     "-m",
     "--margin",
@@ -164,8 +180,16 @@ VERSION = "0.4.0"
     "--threads",
     type=int,
     default=-1,
-    help="Number of threads to use to generate frames. Use values <= 0 for number of available threads on your "
-    "machine minus the provided absolute value.",
+    help="Number of workers (processes or threads) to use to generate frames. Use values <= 0 for number of "
+    "available threads on your machine minus the provided absolute value.",
+    show_default=True,
+)
+@click.option(
+    "--executor",
+    type=click.Choice(["process", "thread"]),
+    default="process",
+    help="Type of workers used to generate frames. Processes scale better with the number of cores, "
+    "threads avoid copying the images to the workers.",
     show_default=True,
 )
 @click.option(
@@ -175,6 +199,14 @@ VERSION = "0.4.0"
     help="Temporary directory to store frames.",
     show_default=True,
 )
+@click.option(
+    "--frame-format",
+    type=click.Choice(FRAME_FORMATS),
+    default=DEFAULT_FRAME_FORMAT,
+    help="Format of the frames stored in the temporary directory. JPEG frames are faster to write and read, "
+    "but they are not lossless. BMP frames are not compressed, so they are the fastest to write, but they take the most space.",
+    show_default=True,
+)
 @click.option(
     "--keep-frames",
     is_flag=True,
@@ -208,7 +240,8 @@ VERSION = "0.4.0"
     "--resume",
     is_flag=True,
     default=False,
-    help="Resume generation of the video.",
+    help="Resume generation of the video. Frames are saved to the temporary directory, so the generation can be "
+    "resumed if it was interrupted.",
     show_default=True,
 )
 @click.option(
@@ -234,10 +267,14 @@ def zoom_video_composer_cli(
     height=1,
     resampling=DEFAULT_RESAMPLING_KEY,
     super_sampling=1.0,
+    final_resampling_auto=True,
+    zoom_steps=0,
     margin=0.05,
     output="output.mp4",
     threads=-1,
+    executor="process",
     tmp_dir="tmp",
+    frame_format=DEFAULT_FRAME_FORMAT,
     keep_frames=False,
     skip_video_generation=False,
     image_engine=DEFAULT_IMAGE_ENGINE,
@@ -260,10 +297,14 @@ def zoom_video_composer_cli(
         height,
         resampling,
         super_sampling,
+        final_resampling_auto,
+        zoom_steps,
         margin,
         output,
         threads,
+        executor,
         tmp_dir,
+        frame_format,
         keep_frames,
         skip_video_generation,
         image_engine,
@@ -287,10 +328,14 @@ def zoom_video_composer(
     height=1,
     resampling=DEFAULT_RESAMPLING_KEY,
     super_sampling=1.0,
+    final_resampling_auto=True,
+    zoom_steps=0,
     margin=0.05,
     output="output.mp4",
     threads=-1,
+    executor="thread",
     tmp_dir="tmp",
+    frame_format=DEFAULT_FRAME_FORMAT,
     keep_frames=False,
     skip_video_generation=False,
     image_engine=DEFAULT_IMAGE_ENGINE,
@@ -301,102 +346,268 @@ def zoom_video_composer(
     start_time = time.time()
 
     """Compose a zoom video from multiple provided images."""
-    video_params = f"zoom={zoom}, fps={fps}, dur={duration}, easing={easing}, easing_power={easing_power}, ease_duration={ease_duration}, direction={direction}, resampling={resampling}, margin={margin}, width={width}, height={height}, super_sampling={super_sampling}"
+    video_params = f"zoom={zoom}, fps={fps}, dur={duration}, easing={easing}, easing_power={easing_power}, ease_duration={ease_duration}, direction={direction}, resampling={resampling}, margin={margin}, width={width}, height={height}, super_sampling={super_sampling}, final_resampling_auto={final_resampling_auto}, zoom_steps={zoom_steps}"
     logger(f"Starting zoom video composition with parameters:\n{video_params}")
 
-    # Read images
-    image_paths = get_image_paths(image_paths)
-    logger(f"Reading {len(image_paths)} image files ...")
-    images = read_images(image_paths, logger, image_engine)
-
-    # Setup some additional variables
-    easing_func = get_easing_function(easing, easing_power, ease_duration)
-    resampling_func = get_resampling_function(resampling, image_engine)
+    n_jobs = threads if threads > 0 else cpu_count() - threads
 
-    num_images = len(images) - 1
+    image_paths = get_image_paths(image_paths, logger)
     num_frames = int(duration * fps)
     num_frames_half = int(num_frames / 2)
-    video_params_to_hash = video_params + "".join(image_paths)
+    # Separator keeps different lists of paths from joining into the same string,
+    # modification times and sizes of the files make the changed images invalidate the old frames
+    video_params_to_hash = "\0".join(
+        [video_params] + [get_file_signature(path) for path in image_paths]
+    )
     tmp_dir_hash = os.path.join(
-        tmp_dir, md5(video_params_to_hash.encode("utf-8")).hexdigest()
+        tmp_dir,
+        blake2b(video_params_to_hash.encode("utf-8"), digest_size=16).hexdigest(),
     )
 
-    # Calculate sizes based on arguments
-    width, height, margin = get_sizes(images[0], width, height, margin)
+    # Frames are saved to the tmp dir only if they are needed after the generation,
+    # otherwise they are piped directly to ffmpeg
+    save_frames = keep_frames or skip_video_generation or resume
 
-    # Create tmp dir
-    if not os.path.exists(tmp_dir_hash):
-        logger(f"Creating temporary directory for frames: {tmp_dir_hash} ...")
-        os.makedirs(tmp_dir_hash, exist_ok=True)
+    # Resume from the first missing frame
+    start_frame = 0
+    if resume and not blend_images_only:
+        start_frame = get_num_saved_frames(tmp_dir_hash, frame_format)
 
-    # Reverse images
-    images = images_reverse(images, direction, reverse_images)
+    if start_frame and start_frame >= num_frames:
+        # All the frames already exist, so there is no need to read the images again
+        logger(
+            f"All {num_frames} frames found in {tmp_dir_hash}, skipping rendering ..."
+        )
+        with Image.open(get_frame_path(tmp_dir_hash, 0, frame_format)) as frame:
+            width, height = frame.size
+    else:
+        if image_engine == "pil":
+            logger(
+                "PIL image engine is used, cv2 and numpy image engines are usually faster"
+            )
+            if not pillow_simd_available():
+                logger(
+                    "Installing Pillow-SIMD instead of Pillow speeds up the PIL image engine"
+                )
 
-    # Blend images (take care of margins)
-    logger(f"Blending {len(images)} images ...")
-    images = blend_images(images, margin, zoom, resampling_func)
+        # Read images
+        logger(f"Reading {len(image_paths)} image files ...")
+        images = read_images(image_paths, image_engine, executor, n_jobs)
 
-    # Stop here if only blending images
-    if blend_images_only:
-        blended_images_path = os.path.join(tmp_dir_hash, "blended_images")
-        images = images_reverse(images, direction, False)
-        save_images(images, blended_images_path, files_prefix="blended_")
-        logger(f"Blended images written to {blended_images_path}. All done!")
-        return
+        # Setup some additional variables
+        easing_func = get_easing_function(easing, easing_power, ease_duration)
+        resampling_func = get_resampling_function(resampling, image_engine)
+        downscale_resampling_func = None
+        if final_resampling_auto:
+            downscale_resampling_func = get_resampling_function(
+                DOWNSCALE_RESAMPLING_KEY, image_engine
+            )
 
-    if super_sampling != 1.0:
-        logger(f"Super sampling images {super_sampling} ...")
-        images = resize_images(images, super_sampling, resampling_func)
+        # Calculate sizes based on arguments
+        width, height, margin = get_sizes(images[0], width, height, margin)
 
-    # Create frames
-    n_jobs = threads if threads > 0 else cpu_count() - threads
-    logger(f"Creating frames in {n_jobs} threads ...")
+        # The frames at the largest zoom need the crop of the size of the image divided by the zoom.
+        # The blended images written for inspection keep the full resolution.
+        reduced_width = width * zoom * super_sampling
+        reduced_height = height * zoom * super_sampling
+        if (
+            not blend_images_only
+            and images[0].width // 2 >= reduced_width
+            and images[0].height // 2 >= reduced_height
+        ):
+            logger(f"Reducing {len(images)} images larger than needed ...")
+            original_width = images[0].width
+            images = reduce_images(images, reduced_width, reduced_height)
+            # Margin is given in the pixels of the original images, all of them are reduced by the same factor
+            margin = int(margin * images[0].width / original_width)
 
-    start_frame = 0
-    if resume:
-        while os.path.exists(os.path.join(tmp_dir_hash, f"{start_frame:06d}.png")):
-            start_frame += 1
-
-    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
-        futures = [
-            executor.submit(
-                process_frame,
-                i,
-                images,
-                direction,
-                easing_func,
-                num_frames,
-                num_frames_half,
-                num_images,
-                zoom,
+        # Reverse images
+        images = images_reverse(images, direction, reverse_images)
+
+        # Blend images (take care of margins)
+        logger(f"Blending {len(images)} images ...")
+        images = blend_images(images, margin, zoom, resampling_func)
+
+        # Stop here if only blending images
+        if blend_images_only:
+            blended_images_path = os.path.join(tmp_dir_hash, "blended_images")
+            images = images_reverse(images, direction, False)
+            save_images(images, blended_images_path, files_prefix="blended_")
+            logger(f"Blended images written to {blended_images_path}. All done!")
+            return
+
+        num_images = len(images) - 1
+
+        if super_sampling != 1.0:
+            logger(f"Super sampling images {super_sampling} ...")
+            images = resize_images(images, super_sampling, resampling_func)
+
+        if save_frames and not os.path.exists(tmp_dir_hash):
+            logger(f"Creating temporary directory for frames: {tmp_dir_hash} ...")
+            os.makedirs(tmp_dir_hash, exist_ok=True)
+
+        # Create frames
+        # Downscaled versions of the images are used for the frames that don't need the full resolution
+        image_class = images[0].__class__
+        pyramids = build_pyramids(
+            images, width * super_sampling, height * super_sampling
+        )
+
+        image_idx, local_zoom = get_zoom_schedule(
+            direction,
+            easing_func,
+            num_frames,
+            num_frames_half,
+            num_images,
+            zoom,
+            zoom_steps,
+        )
+
+        frame_ids = get_frame_ids(
+            pyramids, image_idx, local_zoom, width, height, super_sampling
+        )
+        logger(
+            f"Number of unique frames: {frame_ids.max() + 1} out of {num_frames} ..."
+        )
+
+        # When the frames are piped to ffmpeg, the workers convert them to yuv420p used by the encoder,
+        # it is only supported by even frame sizes
+        yuv420 = not save_frames and width % 2 == 0 and height % 2 == 0
+
+        frame_state = {
+            "pyramids": pyramids,
+            "image_idx": image_idx,
+            "local_zoom": local_zoom,
+            "width": width,
+            "height": height,
+            "resampling_func": resampling_func,
+            "downscale_resampling_func": downscale_resampling_func,
+            "pyramid_scale": super_sampling,
+            "image_engine": image_engine,
+            "yuv420": yuv420,
+        }
+
+        # Executor can be also provided by the user, so an existing pool can be reused,
+        # in this case the state is sent together with the frames
+        shared_images = None
+        if isinstance(executor, Executor):
+            logger("Creating frames using the provided executor ...")
+            frames_executor = executor
+            process_frame_func = partial(process_frame_in_worker, state=frame_state)
+        elif executor in ["process", "thread"]:
+            # GPU images cannot be passed to other processes
+            if executor == "process" and issubclass(image_class, ImageCUDA):
+                logger("CUDA image engine doesn't support processes, using threads ...")
+                executor = "thread"
+            logger(
+                f"Creating frames in {n_jobs} {'processes' if executor == 'process' else 'threads'} ..."
+            )
+            shared_images_specs = None
+            if executor == "process":
+                shared_images, shared_images_layout = share_images(pyramids)
+                shared_images_specs = (shared_images.name, shared_images_layout)
+                frame_state["pyramids"] = None
+                # The workers use the shared copy, so the main process can release its own images
+                images = pyramids = None
+            executor_kwargs = {}
+            if executor == "process":
+                executor_class = ProcessPoolExecutor
+                # Forking a process that already used threads (e.g. of OpenCV or libvips) can deadlock the workers
+                executor_kwargs["mp_context"] = get_context(
+                    "forkserver" if "forkserver" in get_all_start_methods() else "spawn"
+                )
+            else:
+                executor_class = ThreadPoolExecutor
+            frames_executor = executor_class(
+                max_workers=n_jobs,
+                initializer=init_frame_worker,
+                initargs=(frame_state, shared_images_specs),
+                **executor_kwargs,
+            )
+            process_frame_func = process_frame_in_worker
+        else:
+            raise ValueError(f"Unsupported executor: {executor}")
+
+        if save_frames:
+            video_writer = FramesSaver(
+                tmp_dir_hash,
+                frame_format,
+                image_class,
                 width,
                 height,
-                resampling_func,
-                tmp_dir_hash,
+                start_frame,
+                n_jobs,
+                queue_size=2 * n_jobs,
+            )
+        else:
+            logger(f"Writing video to: {output} ...")
+            video_writer = FFmpegWriter(
+                output,
+                width,
+                height,
+                fps,
+                "yuv420p" if yuv420 else image_class.pix_fmt,
+                audio_path,
+                num_frames / fps,
+                n_jobs,
+                queue_size=2 * fps,
             )
-            for i in range(start_frame, num_frames)
-        ]
+
+        num_frames_to_process = num_frames - start_frame
+        # Consecutive frames with the same id are generated once
+        frame_runs = get_frame_runs(range(start_frame, num_frames), frame_ids)
+        if isinstance(executor, Executor):
+            # The state is sent to the provided executor with each chunk, so the frames are split into few large chunks
+            chunksize = max(1, len(frame_runs) // (4 * n_jobs))
+        else:
+            # Small chunks and the limited number of them in flight bound the memory used by the generated frames
+            chunksize = max(1, min(len(frame_runs) // (4 * n_jobs), 4))
         try:
-            completed = concurrent.futures.as_completed(futures)
-            for _ in tqdm(
-                range(num_frames - start_frame), desc="Generating the frames"
+            for frame_bytes in tqdm(
+                map_frames(
+                    frames_executor,
+                    process_frame_func,
+                    frame_runs,
+                    chunksize=chunksize,
+                    max_pending=2 * n_jobs,
+                ),
+                total=num_frames_to_process,
+                desc="Generating the frames",
             ):
-                completed.__next__()
-        except KeyboardInterrupt:
-            executor.shutdown(wait=False, cancel_futures=True)
+                video_writer.write(frame_bytes)
+        except BaseException as e:
+            if isinstance(e, KeyboardInterrupt):
+                frames_executor.shutdown(wait=False, cancel_futures=True)
+            video_writer.kill()
             raise
+        finally:
+            if frames_executor is not executor:
+                frames_executor.shutdown()
+            release_shared_images(shared_images)
 
-    # Images are no longer needed
-    del images
+        video_writer.close()
+
+        # Images are no longer needed
+        del images, pyramids, frame_state
 
-    # Create video clip using images in tmp dir and audio if provided
     if skip_video_generation:
         logger("Skipping video generation. All done!")
         return
 
-    else:
+    # Create video clip using images in tmp dir and audio if provided
+    if save_frames:
         logger(f"Writting video in {n_jobs} threads to: {output} ...")
-        create_video_clip(output, fps, num_frames, tmp_dir_hash, audio_path, n_jobs)
+        create_video_clip(
+            output,
+            fps,
+            num_frames,
+            tmp_dir_hash,
+            audio_path,
+            n_jobs,
+            width,
+            height,
+            frame_format,
+        )
 
         # Remove tmp dir
         if not keep_frames:
@@ -405,9 +616,9 @@ def zoom_video_composer(
             if not os.listdir(tmp_dir):
                 os.rmdir(tmp_dir)
 
-        logger(f"Total time: {round(time.time() - start_time, 2)}s")
-        logger("All done!")
-        return output
+    logger(f"Total time: {round(time.time() - start_time, 2)}s")
+    logger("All done!")
+    return output
 
 if __name__ == "__main__":
     zoom_video_composer_cli()